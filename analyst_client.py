@@ -2,6 +2,8 @@ from sys import argv
 import socket
 import struct
 import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 import SPADE
 
 # Dict mapping numeric values to dinucleotides to allow
@@ -26,11 +28,66 @@ DINUCLEOTIDE_VALUE_TABLE = {
 }
 
 
+# Maximum amount of datapoints held by the analyst cache
+CACHE_SIZE = 1000000
+
+# Maximum amount of users of a batch analysis waiting to be decrypted
+BATCH_PENDING = 32
+
+
+# Class for caching parsed encrypted data and decrypted results of the analyst client.
+# Entries are keyed by user and dataset version and evicted least recently used first
+# once the total amount of cached datapoints exceeds the maximum size.
+class AnalystCache:
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size  # Maximum amount of cached datapoints
+        self.size = 0  # Current amount of cached datapoints
+        # Cached values and their sizes, least recently used first
+        self.entries = OrderedDict()
+        # Latest dataset version reported by the server for each user
+        self.versions = {}
+        self.params = {}  # Public parameters for each data length, these never change
+
+    # Function for registering the dataset version reported by the server for a user
+    def check_version(self, user_id, version):
+        # Drop everything cached for the user once the server reports a new version
+        if self.versions.get(user_id, version) != version:
+            self.invalidate(user_id)
+        self.versions[user_id] = version
+
+    # Function for removing all cached entries of a user
+    def invalidate(self, user_id):
+        for key in [key for key in self.entries if key[1] == user_id]:
+            self.size -= self.entries.pop(key)[1]
+
+    # Function for retrieving a cached value, returns None if it is not cached
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)  # Mark as most recently used
+        return self.entries[key][0]
+
+    # Function for caching a value taking up size datapoints
+    def put(self, key, value, size):
+        if size > self.max_size:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+
+        # Evict least recently used entries until the cache fits its maximum size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+
 # Class for SPADE analyst client
 class SPADEAnalyst:
-    def __init__(self, host, port):
+    def __init__(self, host, port, cache_size=CACHE_SIZE):
         self.host = host  # Server host
         self.port = port  # Server port
+        self.cache = AnalystCache(cache_size)  # Cache for encrypted data and results
 
     # Function for sending requests to the SPADE server
     def send_request(self, request):
@@ -40,22 +97,45 @@ class SPADEAnalyst:
             client.sendall(struct.pack("!I", len(serialized_data)))  # Send data length
             client.sendall(serialized_data)  # Send the actual request data
 
-            # Receive data length header
-            raw_length = client.recv(4)
-            if not raw_length:
+            response = self.recv_frame(client)  # Receive response
+            return response
+
+    # Function for sending a request and iterating over a streamed response from the SPADE server
+    def send_stream_request(self, request):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+            client.connect((self.host, self.port))  # Connect to server
+            serialized_data = pickle.dumps(request)  # Serialize request data
+            client.sendall(struct.pack("!I", len(serialized_data)))  # Send data length
+            client.sendall(serialized_data)  # Send the actual request data
+
+            # Yield response frames until the server sends the closing frame
+            while True:
+                response = self.recv_frame(client)
+                if response.get("done"):
+                    break
+                yield response
+
+    # Function for receiving a single length prefixed response frame
+    def recv_frame(self, client):
+        # Receive data length header
+        raw_length = b""
+        while len(raw_length) < 4:
+            packet = client.recv(4 - len(raw_length))
+            if not packet:
                 raise EOFError("No data length header received.")
-            data_length = struct.unpack("!I", raw_length)[0]
+            raw_length += packet
+        data_length = struct.unpack("!I", raw_length)[0]
 
-            # Receive actual response in chunks
-            data = b""
-            while len(data) < data_length:
-                packet = client.recv(16384)
-                if not packet:
-                    raise EOFError("Connection closed before all data received.")
-                data += packet
+        # Receive actual response in chunks, never reading past the end of the frame
+        data = b""
+        while len(data) < data_length:
+            packet = client.recv(min(16384, data_length - len(data)))
+            if not packet:
+                raise EOFError("Connection closed before all data received.")
+            data += packet
 
-            response = pickle.loads(data)  # Deserialize response
-            return response
+        response = pickle.loads(data)  # Deserialize response
+        return response
 
     # Function for requesting a derived key from the SPADE server
     def derive_key(self, user_id, v):
@@ -65,10 +145,53 @@ class SPADEAnalyst:
         # Check that server did not run into an error
         if response.get("error") is not None:
             print("Error: User not found.")
-            return 0, 0, 0
+            return 0, 0, 0, 0
+
+        # Return derived key, encrypted data, data length and dataset version
+        return (
+            response.get("dk"),
+            response.get("encrypted_data"),
+            response.get("n"),
+            response.get("version"),
+        )
+
+    # Function for requesting the version of a user's stored data from the SPADE server
+    def get_dataset_version(self, user_id):
+        request = {"action": "get_dataset_version", "user_id": user_id}
+        response = self.send_request(request)  # Send request and receive response
+
+        # Check that server did not run into an error
+        if response.get("error") is not None:
+            print(f"Error: {response['error']}")
+            return None
+
+        return response.get("version")
+
+    # Function for requesting derived keys for several users and values from the SPADE server
+    def derive_key_batch(self, user_ids, values):
+        request = {"action": "derive_key_batch", "user_ids": user_ids, "values": values}
+
+        # Yield frames of derived keys grouped by data length as they arrive
+        return self.send_stream_request(request)
+
+    # Function for streaming a range of a user's encrypted data from the server's blob store
+    def download_data(self, user_id, offset=0, length=None):
+        request = {
+            "action": "download_data",
+            "user_id": user_id,
+            "offset": offset,
+            "length": length,
+        }
+        frames = self.send_stream_request(request)
+
+        # First frame describes the range or holds an error
+        response = next(frames)
+        if response.get("error") is not None:
+            raise LookupError(response["error"])
 
-        # Return derived key, encrypted data and data length
-        return response.get("dk"), response.get("encrypted_data"), response.get("n")
+        # Yield chunks of the requested range as they arrive
+        for frame in frames:
+            yield frame["chunk"]
 
     # Function for requesting public parameters for data length n
     def get_public_parameters(self, n):
@@ -93,6 +216,9 @@ def hypnogram_interface(client):
             print(
                 "     > analyze     | Analyze encrypted hypnogram data. Asks for user id and value."
             )
+            print(
+                "     > batch       | Analyze encrypted hypnogram data of several users. Asks for user ids and values."
+            )
             print(
                 "     > back        | Returns to the previous interface where you can choose data type to analyze."
             )
@@ -101,13 +227,14 @@ def hypnogram_interface(client):
             user_id = int(input("Enter user_id: "))
             value = int(input("Enter value: "))
 
-            data, dk, n = get_encrypted_data(client, user_id, value)
-            if data == 0:
+            result = get_decrypted_data(client, user_id, value)
+            if result is None:
                 print("Something went wrong.")
                 continue
 
-            result = decrypt(client, data, dk, n, value)
             analyze_hypnogram(result, value)
+        elif cmd == "batch":
+            batch_command(client)
         else:
             print("Unknown command.")
 
@@ -127,6 +254,9 @@ def dna_interface(client):
             print(
                 "     > analyze     | Analyze encrypted dna data. Asks for user id and value."
             )
+            print(
+                "     > batch       | Analyze encrypted dna data of several users. Asks for user ids and values."
+            )
             print(
                 "     > back        | Returns to the previous interface where you can choose data type to analyze."
             )
@@ -135,13 +265,14 @@ def dna_interface(client):
             user_id = int(input("Enter user_id: "))
             value = int(input("Enter value: "))
 
-            data, dk, n = get_encrypted_data(client, user_id, value)
-            if data == 0:
+            result = get_decrypted_data(client, user_id, value)
+            if result is None:
                 print("Something went wrong.")
                 continue
 
-            result = decrypt(client, data, dk, n, value)
             analyze_genome(result, value)
+        elif cmd == "batch":
+            batch_command(client, DINUCLEOTIDE_VALUE_TABLE.get)
         else:
             print("Unknown command.")
 
@@ -149,44 +280,107 @@ def dna_interface(client):
 # Function for fetching encrypted data information from the SPADE server
 def get_encrypted_data(client, user_id, value):
     # Fetch required information from SPADE server
-    dk, encrypted_data, n = client.derive_key(user_id, value)
+    dk, encrypted_data, n, version = client.derive_key(user_id, value)
 
     # Error check
     if dk == 0:
         return 0, 0, 0
 
-    # Compile the encrypted data based on the received information
-    h = []
-    c = []
-    h_done = False
-    filename = ""
+    # Reuse the parsed encrypted data if this version of the user's data is cached
+    client.cache.check_version(user_id, version)
+    key = ("data", user_id, version)
+    data = client.cache.get(key)
+    if data is None:
+        data = load_encrypted_data(client, user_id, encrypted_data)
+        client.cache.put(key, data, 2 * n)
+
+    # Return encrypted data, derived key and data length
+    return data, dk, n
+
+
+# Function for fetching and partially decrypting a user's data for value v, using cached results
+def get_decrypted_data(client, user_id, value):
+    # A cached result is only used once the server confirms the data has not changed since
+    known_version = client.cache.versions.get(user_id)
+    result = client.cache.get(("result", user_id, value, known_version))
+    if result is not None:
+        version = client.get_dataset_version(user_id)
+        if version is None:
+            return None
+        client.cache.check_version(user_id, version)
+        if version == known_version:
+            return result
+
+    # On a miss the version reported with the derived key is used instead
+    data, dk, n = get_encrypted_data(client, user_id, value)
+    if data == 0:
+        return None
+
+    result = decrypt(client, data, dk, n, value)
+    client.cache.put(
+        ("result", user_id, value, client.cache.versions[user_id]), result, n
+    )
+
+    # Return the partially decrypted data
+    return result
+
 
-    # Check if the received encrypted data is in a file or in the response
+# Function for compiling the encrypted data based on the information received from the server
+def load_encrypted_data(client, user_id, encrypted_data):
+    # Check if the received encrypted data is in a file, in the blob store or in the response
     if encrypted_data[0].startswith("file:"):
         enc_file = encrypted_data[0].split(":")
         filename = enc_file[1]
 
         with open(filename, "r") as file:
-            for datapoint in file:
-                if datapoint.strip() == ":":
-                    h_done = True
-                else:
-                    if h_done:
-                        c.append(int(datapoint.strip()))
-                    else:
-                        h.append(int(datapoint.strip()))
+            h, c = parse_encrypted(file)
+    elif encrypted_data[0].startswith("blob:"):
+        # Parse the data while it is streamed from the server's blob store
+        h, c = parse_encrypted(iter_lines(client.download_data(user_id)))
     else:
         h, c = encrypted_data[0]["h"], encrypted_data[0]["c"]
 
-    data = {"h": h, "c": c}
+    # Return the encrypted data
+    return {"h": h, "c": c}
 
-    # Return encrypted data, derived key and data length
-    return data, dk, n
+
+# Function for parsing helping information and ciphertext from lines of an encrypted data file
+def parse_encrypted(lines):
+    h = []
+    c = []
+    h_done = False
+
+    for datapoint in lines:
+        if datapoint.strip() == ":":
+            h_done = True
+        else:
+            if h_done:
+                c.append(int(datapoint.strip()))
+            else:
+                h.append(int(datapoint.strip()))
+
+    return h, c
+
+
+# Function for splitting streamed chunks of bytes into lines of text
+def iter_lines(chunks):
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()  # Last line may continue in the next chunk
+        for line in lines:
+            yield line.decode()
+
+    if rest:
+        yield rest.decode()
 
 
 # Function for decrypting the encrypted data using the derived key
 def decrypt(client, data, dk, n, v):
-    q, g, mpk = client.get_public_parameters(n)  # Fetch public params
+    # Fetch public params unless they are cached for data length n
+    if n not in client.cache.params:
+        client.cache.params[n] = client.get_public_parameters(n)
+    q, g, mpk = client.cache.params[n]
     cipher = SPADE.SPADE(n, q, g, mpk)  # Initialize SPADE cipher instance
 
     c = data["c"]  # Cipher text
@@ -197,6 +391,150 @@ def decrypt(client, data, dk, n, v):
     return y
 
 
+# Function for loading and decrypting a single user's data for several values, ran in worker processes
+def decrypt_user(client, user_id, params, encrypted_data, dks, blob=None):
+    n, q, g, mpk = params
+    if blob is not None:
+        # Uploaded data sent along with the derived keys
+        h, c = parse_encrypted(iter_lines([blob]))
+        data = {"h": h, "c": c}
+    else:
+        data = load_encrypted_data(client, user_id, encrypted_data)
+    cipher = SPADE.SPADE(n, q, g, mpk)  # Initialize SPADE cipher instance
+
+    # Partially decrypt the data for every requested value and summarize the result
+    return {
+        v: summarize_indicator(cipher.decrypt(dk, data["c"], data["h"], v))
+        for v, dk in dks.items()
+    }
+
+
+# Function for computing statistics of a partially decrypted indicator vector
+def summarize_indicator(data):
+    count = data.count(1)  # Amount of datapoints matching the value
+    breaks = sum(1 for i in range(len(data) - 1) if data[i] == 1 and data[i + 1] != 1)
+
+    # Compute the longest sequence of the value
+    longest = 0
+    sequence = 0
+    for datapoint in data:
+        sequence = sequence + 1 if datapoint == 1 else 0
+        longest = max(longest, sequence)
+
+    return {
+        "n": len(data),
+        "count": count,
+        "fraction": count / len(data) if data else 0.0,
+        "breaks": breaks,
+        "longest": longest,
+    }
+
+
+# Function for decrypting and analyzing the data of several users in parallel
+def analyze_batch(client, user_ids, values, workers=None):
+    results = {}  # Per user statistics for each value
+    errors = []  # Users the server could not derive keys for
+
+    # Workers only need a client for loading data, not the cache of this one
+    worker_client = SPADEAnalyst(client.host, client.port, cache_size=0)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}  # Futures of users being decrypted
+        params = {}  # Public parameters of each SPADE instance in the batch
+        for frame in client.derive_key_batch(user_ids, values):
+            if "errors" in frame:
+                errors.extend(frame["errors"])
+                continue
+
+            # Public parameters are sent once before the users sharing a SPADE instance
+            n = frame["n"]
+            if "mpk" in frame:
+                params[n] = (n, frame["q"], frame["g"], frame["mpk"])
+                client.cache.params[n] = (frame["q"], frame["g"], frame["mpk"])
+                continue
+
+            # Frames hold everything needed to decrypt the user, so decryption starts
+            # while the rest of the stream is still arriving
+            user_id = frame["user_id"]
+            client.cache.check_version(user_id, frame["version"])
+            future = executor.submit(
+                decrypt_user,
+                worker_client,
+                user_id,
+                params[n],
+                frame["encrypted_data"],
+                frame["dks"],
+                frame.get("blob"),
+            )
+            pending[future] = user_id
+
+            # Stop reading the stream while too many users wait to be decrypted
+            if len(pending) >= BATCH_PENDING:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+
+        for future in as_completed(pending):
+            results[pending[future]] = future.result()
+
+    # Compute aggregate statistics over all analyzed users for each value
+    aggregate = {}
+    for v in values:
+        stats = [user_stats[v] for user_stats in results.values()]
+        if not stats:
+            continue
+        counts = [stat["count"] for stat in stats]
+        aggregate[v] = {
+            "users": len(stats),
+            "users_with_value": sum(1 for count in counts if count > 0),
+            "total_count": sum(counts),
+            "min_count": min(counts),
+            "max_count": max(counts),
+            "mean_count": sum(counts) / len(stats),
+            "mean_fraction": sum(stat["fraction"] for stat in stats) / len(stats),
+        }
+
+    return results, aggregate, errors
+
+
+# Function for printing the results of a batch analysis
+def print_batch_results(results, aggregate, errors, label=str):
+    for error in errors:
+        print(f"User {error['user_id']}: {error['error']}")
+
+    for user_id in sorted(results):
+        print(f"\nUser {user_id}:")
+        for v, stat in results[user_id].items():
+            print(
+                f"---     {label(v)}: {stat['count']}/{stat['n']} datapoints ({stat['fraction']:.2%}), "
+                f"{stat['breaks']} changes, longest sequence {stat['longest']}"
+            )
+
+    print("\nAggregate:")
+    for v, stat in aggregate.items():
+        print(
+            f"---     {label(v)}: present for {stat['users_with_value']}/{stat['users']} users, "
+            f"total {stat['total_count']}, per user min {stat['min_count']} / "
+            f"mean {stat['mean_count']:.2f} / max {stat['max_count']}, "
+            f"mean fraction {stat['mean_fraction']:.2%}"
+        )
+
+
+# Function for asking the analyst for users and values and running a batch analysis
+def batch_command(client, label=str):
+    try:
+        user_ids = [
+            int(x) for x in input("Enter user_ids (comma separated): ").split(",")
+        ]
+        values = [int(x) for x in input("Enter values (comma separated): ").split(",")]
+    except ValueError:
+        print("Invalid input.")
+        return
+
+    results, aggregate, errors = analyze_batch(client, user_ids, values)
+    print_batch_results(results, aggregate, errors, label)
+
+
 # Function for analyzing partially decrypted hypnogram data
 def analyze_hypnogram(data, v):
     # Compute how many times value appears and changes inside the data
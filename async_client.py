@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import pickle
+import struct
+import weakref
+import SPADE
+import user_client
+import analyst_client
+
+###-----CONFIG-----###
+
+MAX_REQUESTS = 64  # Default amount of requests allowed to be in flight at once
+
+# Semaphores shared by all clients without their own semaphore, one for each event loop
+SHARED_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+# Function for getting the semaphore shared by the clients running in the current event loop
+def shared_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in SHARED_SEMAPHORES:
+        SHARED_SEMAPHORES[loop] = asyncio.Semaphore(MAX_REQUESTS)
+    return SHARED_SEMAPHORES[loop]
+
+
+# Function for encrypting data using the SPADE algorithm, ran inside an executor
+def encrypt_data(params, data, alpha_j):
+    n, q, g, mpk = params
+    cipher = SPADE.SPADE(n, q, g, mpk)  # Create SPADE cipher instance
+    return cipher.encrypt(data, alpha_j)
+
+
+# Function for partially decrypting data using the SPADE algorithm, ran inside an executor
+def decrypt_data(params, dk, data, v):
+    n, q, g, mpk = params
+    cipher = SPADE.SPADE(n, q, g, mpk)  # Create SPADE cipher instance
+    return cipher.decrypt(dk, data["c"], data["h"], v)
+
+
+# Function for reading a chunk of a file starting at offset, ran inside an executor
+def read_chunk(filename, offset, size):
+    with open(filename, "rb") as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+# Function for parsing downloaded chunks of an encrypted data file, ran inside an executor
+def parse_chunks(chunks):
+    return analyst_client.parse_encrypted(analyst_client.iter_lines(chunks))
+
+
+# Base class for asyncio SPADE clients
+class AsyncSPADEClient:
+    def __init__(self, host, port, semaphore=None, executor=None):
+        self.host = host  # Server host address
+        self.port = port  # Server port num
+
+        # Semaphore bounding the amount of concurrent requests. By default all clients in an
+        # event loop share one, so the total amount of connections stays at MAX_REQUESTS.
+        # Passing a semaphore gives the client its own limit instead.
+        self.semaphore = semaphore
+
+        # Executor used for CPU heavy SPADE work and file access. None uses the default
+        # executor of the event loop, a ProcessPoolExecutor allows using multiple cores.
+        self.executor = executor
+
+    # Function for getting the semaphore bounding the requests of this client
+    def get_semaphore(self):
+        if self.semaphore is not None:
+            return self.semaphore
+        return shared_semaphore()
+
+    # Function for sending requests to the SPADE server
+    async def send_request(self, request):
+        async with self.get_semaphore():
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self.send_frame(writer, request)  # Send the request
+                return await self.recv_frame(reader)  # Receive response
+            finally:
+                writer.close()
+                await writer.wait_closed()
+
+    # Function for sending a single length prefixed frame to the server
+    async def send_frame(self, writer, request):
+        serialized_data = pickle.dumps(request)  # Serialize request data
+        writer.write(struct.pack("!I", len(serialized_data)))  # Send data length
+        writer.write(serialized_data)  # Send the actual request data
+        await writer.drain()
+
+    # Function for receiving a single length prefixed response frame
+    async def recv_frame(self, reader):
+        # Receive data length header and the actual response
+        try:
+            raw_length = await reader.readexactly(4)
+            data_length = struct.unpack("!I", raw_length)[0]
+            data = await reader.readexactly(data_length)
+        except asyncio.IncompleteReadError:
+            raise EOFError("Connection closed before all data received.")
+
+        response = pickle.loads(data)  # Deserialize response
+        return response
+
+    # Function for running a blocking function inside the executor
+    async def run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    # Function for requesting public parameters for data length n
+    async def get_public_parameters(self, n):
+        request = {"action": "get_public_parameters", "n": n}  # Form request
+        response = await self.send_request(request)  # Send request and receive response
+
+        # Return public parameters from response
+        return response.get("q"), response.get("g"), response.get("mpk")
+
+
+# Class for asyncio SPADE user client
+class AsyncSPADEUser(AsyncSPADEClient):
+    def __init__(self, host, port, semaphore=None, executor=None):
+        super().__init__(host, port, semaphore, executor)
+        self.user_id = None  # User ID assigned after registration
+        self.private_key = None  # User private key
+        self.public_key = None  # User public key
+
+    # Function for registering the user on the SPADE server
+    async def register(self):
+        request = {"action": "register_user"}  # Request for registration
+        response = await self.send_request(request)  # Send request and receive response
+        self.user_id = response.get("user_id")  # Retrieve user ID
+        self.private_key = response.get("alpha_j")  # Retrieve private key
+        self.public_key = response.get("g_alpha_j")  # Retrieve public key
+
+    # Function for encrypting dna data from a file and sending resulting information to server
+    async def encrypt_genome(self, filename):
+        data = await self.run_in_executor(user_client.read_genome, filename)
+        await self.encrypt(data, filename)
+
+    # Function for encrypting hypnogram data from a file and sending resulting information to server
+    async def encrypt_hypnogram(self, filename):
+        data = await self.run_in_executor(user_client.read_hypnogram, filename)
+        await self.encrypt(data, filename)
+
+    # Function for encrypting data read from a file and sending resulting information to server
+    async def encrypt(self, data, filename):
+        n = len(data)  # Number of data points
+        q, g, mpk = await self.get_public_parameters(n)  # Retrieve public params
+
+        # Encrypt the data and write it to a new file inside the executor
+        h, c = await self.run_in_executor(
+            encrypt_data, (n, q, g, mpk), data, self.private_key
+        )
+        await self.run_in_executor(
+            user_client.write_encrypted, filename + ".encrypted", h, c
+        )
+
+        # Upload the encrypted data to the server
+        await self.upload_data(filename + ".encrypted", n)
+
+    # Function for streaming an encrypted data file into the server's blob store
+    async def upload_data(self, filename, n):
+        async with self.get_semaphore():
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                request = {"action": "upload_data", "id": self.user_id, "n": n}
+                await self.send_frame(writer, request)
+
+                # Server replies with the chunk size and acknowledgement window to use
+                response = await self.recv_frame(reader)
+                if response.get("error") is not None:
+                    raise KeyError(response["error"])
+
+                chunk_size = response["chunk_size"]
+                window = response["window"]
+
+                # Send the file in chunks and wait for an acknowledgement every window of chunks
+                chunks = 0
+                offset = 0
+                while True:
+                    chunk = await self.run_in_executor(
+                        read_chunk, filename, offset, chunk_size
+                    )
+                    if not chunk:
+                        break
+                    await self.send_frame(writer, {"chunk": chunk})
+                    offset += len(chunk)
+                    chunks += 1
+                    if chunks % window == 0:
+                        await self.recv_frame(reader)
+
+                await self.send_frame(writer, {"done": True})
+                return await self.recv_frame(reader)  # Receive blob information
+            finally:
+                writer.close()
+                await writer.wait_closed()
+
+
+# Class for asyncio SPADE analyst client
+class AsyncSPADEAnalyst(AsyncSPADEClient):
+    # Function for requesting a derived key from the SPADE server
+    async def derive_key(self, user_id, v):
+        request = {"action": "derive_key", "user_id": user_id, "v": v}
+        response = await self.send_request(request)  # Send request and receive response
+
+        # Check that server did not run into an error
+        if response.get("error") is not None:
+            raise KeyError(response.get("error"))
+
+        # Return derived key, encrypted data and data length
+        return response.get("dk"), response.get("encrypted_data"), response.get("n")
+
+    # Function for streaming a range of a user's encrypted data from the server's blob store
+    async def download_data(self, user_id, offset=0, length=None):
+        request = {
+            "action": "download_data",
+            "user_id": user_id,
+            "offset": offset,
+            "length": length,
+        }
+        async with self.get_semaphore():
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self.send_frame(writer, request)
+
+                # First frame describes the range or holds an error
+                response = await self.recv_frame(reader)
+                if response.get("error") is not None:
+                    raise LookupError(response["error"])
+
+                # Yield chunks of the requested range until the closing frame
+                while True:
+                    frame = await self.recv_frame(reader)
+                    if frame.get("done"):
+                        break
+                    yield frame["chunk"]
+            finally:
+                writer.close()
+                await writer.wait_closed()
+
+    # Function for fetching and loading encrypted data from the SPADE server
+    async def get_encrypted_data(self, user_id, v):
+        dk, encrypted_data, n = await self.derive_key(user_id, v)
+        if encrypted_data[0].startswith("blob:"):
+            # Download the data from the server's blob store and parse it inside the executor
+            chunks = [chunk async for chunk in self.download_data(user_id)]
+            h, c = await self.run_in_executor(parse_chunks, chunks)
+            data = {"h": h, "c": c}
+        else:
+            data = await self.run_in_executor(
+                analyst_client.load_encrypted_data, None, user_id, encrypted_data
+            )
+
+        # Return encrypted data, derived key and data length
+        return data, dk, n
+
+    # Function for decrypting the encrypted data using the derived key
+    async def decrypt(self, data, dk, n, v):
+        q, g, mpk = await self.get_public_parameters(n)  # Fetch public params
+        return await self.run_in_executor(decrypt_data, (n, q, g, mpk), dk, data, v)
+
+    # Function for fetching and partially decrypting a user's data for value v
+    async def analyze(self, user_id, v):
+        data, dk, n = await self.get_encrypted_data(user_id, v)
+        return await self.decrypt(data, dk, n, v)
+
+
+# Print information if someone tries to run the script on it's own.
+def main():
+    print("This script is not meant to be ran on it's own.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from sys import argv
+import multiprocessing
+import selectors
+import threading
+import itertools
+import secrets
+import socket
+import struct
+import pickle
+import time
+import server_client
+
+###-----CONFIG-----###
+
+# DEFAULT HOST AND PORT
+HOST = "localhost"  # Default hostname
+PORT = 5000  # Default port num
+
+SHARD_STARTUP_TIMEOUT = 10  # Seconds to wait for local shards to start listening
+
+
+# Class for routing client requests to the shards of a sharded SPADE deployment.
+# User with ID user_id is stored on shard (user_id - 1) % shard count, matching the
+# IDs handed out by the shards themselves.
+class SPADERouter:
+    def __init__(self, host, port, backends, token):
+        self.host = host  # Host address
+        self.port = port  # Port number
+        self.backends = backends  # List of (host, port) of the shards, in index order
+        self.token = token  # Secret shared with the shards for instance replication
+        # Shards new users are registered on, in turns
+        self.registrations = itertools.cycle(range(len(backends)))
+        # Public parameters of SPADE instances replicated to every shard
+        self.instances = {}
+        self.lock = threading.Lock()  # Lock for registration and instance replication
+
+    # Function for handling incoming client requests
+    def handle_request(self, conn):
+        try:
+            start = time.time()  # Starting timer for transaction
+
+            data = self.recv_frame(conn)  # Receive the request data
+            request = pickle.loads(data)
+            action = request.get("action")
+
+            if action == "register_user":
+                # Spread new users over the shards
+                with self.lock:
+                    shard = next(self.registrations)
+                self.forward(conn, shard, data)
+
+            elif action == "get_public_parameters":
+                # Make sure every shard has the same SPADE instance before handing out its mpk
+                self.send_frame(conn, self.get_public_parameters(request.get("n")))
+
+            elif action == "derive_key_batch":
+                # Split the batch between the shards and merge their streamed responses
+                self.derive_key_batch(conn, request)
+
+            elif action in ("export_instance", "import_instance"):
+                # Master secret keys are only exchanged between the router and the shards
+                self.send_frame(conn, {"error": "Unknown action"})
+
+            else:
+                # All other requests are about a single user and are passed on to its shard
+                user_id = request.get("user_id", request.get("id"))
+                if user_id is None:
+                    self.send_frame(conn, {"error": "Unknown action"})
+                else:
+                    self.forward(conn, self.shard_for(user_id), data)
+
+            # Calculating total transaction time and printing information about the transaction.
+            transaction_time = time.time() - start
+            print(f"---Routed {action} in {transaction_time:.5f} seconds.")
+
+        except Exception as err:
+            print(f"Error: {err}")
+        finally:
+            conn.close()  # Close the connection
+
+    # Function for finding the shard index of a user
+    def shard_for(self, user_id):
+        return (user_id - 1) % len(self.backends)
+
+    # Function for opening a connection to a shard
+    def connect(self, shard):
+        return socket.create_connection(self.backends[shard])
+
+    # Function for sending a single request to a shard and returning its response
+    def send_request(self, shard, request):
+        with self.connect(shard) as backend:
+            self.send_frame(backend, request)
+            return pickle.loads(self.recv_frame(backend))
+
+    # Function for passing a request to a shard and relaying traffic in both directions until
+    # the shard closes the connection. This covers single and streamed responses as well as uploads.
+    def forward(self, conn, shard, data):
+        with self.connect(shard) as backend:
+            backend.sendall(struct.pack("!I", len(data)))
+            backend.sendall(data)
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(conn, selectors.EVENT_READ, backend)
+                selector.register(backend, selectors.EVENT_READ, conn)
+                while True:
+                    for key, _ in selector.select():
+                        packet = key.fileobj.recv(65536)
+                        if packet:
+                            key.data.sendall(packet)
+                        elif key.fileobj is backend:
+                            return  # Shard finished its response
+                        else:
+                            # Client is done sending, keep relaying the response
+                            selector.unregister(conn)
+                            backend.shutdown(socket.SHUT_WR)
+
+    # Function for returning public parameters after replicating the SPADE instance to all shards
+    def get_public_parameters(self, n):
+        print("A client is requesting public parameters.")
+
+        # Instances never change once replicated, so their parameters are served by the router
+        params = self.instances.get(n)
+        if params is not None:
+            return params
+
+        with self.lock:
+            # Another request may have replicated the instance while waiting for the lock
+            if n in self.instances:
+                return self.instances[n]
+
+            # The first shard owns the instances, the others receive a copy of its msk
+            request = {"action": "export_instance", "n": n, "token": self.token}
+            instance = self.send_request(0, request)
+            print(f"     Replicating SPADE instance for n of {n}.")
+            for shard in range(1, len(self.backends)):
+                request = {
+                    "action": "import_instance",
+                    "n": n,
+                    "msk": instance["msk"],
+                    "token": self.token,
+                }
+                self.send_request(shard, request)
+
+            params = {"q": instance["q"], "g": instance["g"], "mpk": instance["mpk"]}
+            self.instances[n] = params
+
+        return params
+
+    # Function for splitting a batch key derivation between shards and merging the results
+    def derive_key_batch(self, conn, request):
+        print("A client is requesting a batch of keys and data.")
+        groups = {}
+        for user_id in request.get("user_ids"):
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+
+        for shard, user_ids in groups.items():
+            with self.connect(shard) as backend:
+                self.send_frame(backend, dict(request, user_ids=user_ids))
+
+                # Relay frames of the shard, the closing frame is sent once all shards are done
+                while True:
+                    data = self.recv_frame(backend)
+                    if pickle.loads(data).get("done"):
+                        break
+                    conn.sendall(struct.pack("!I", len(data)))
+                    conn.sendall(data)
+
+        self.send_frame(conn, {"done": True})
+
+    # Function for sending a single length prefixed frame
+    def send_frame(self, conn, response):
+        response_data = pickle.dumps(response)
+        conn.sendall(struct.pack("!I", len(response_data)))  # Send data length header
+        conn.sendall(response_data)  # Send actual response data
+
+    # Function for receiving a single length prefixed frame
+    def recv_frame(self, conn):
+        # Receive a header for the length of the incoming data
+        raw_length = b""
+        while len(raw_length) < 4:
+            packet = conn.recv(4 - len(raw_length))
+            if not packet:
+                raise EOFError("No data length header received.")
+            raw_length += packet
+        data_length = struct.unpack("!I", raw_length)[0]
+
+        # Receiving the actual data in chunks and stopping after received data length is reached.
+        data = b""
+        while len(data) < data_length:
+            packet = conn.recv(min(16384, data_length - len(data)))
+            if not packet:
+                raise EOFError("Connection closed before all data received.")
+            data += packet
+        return data
+
+    # Function for starting the router
+    def run(self):
+        print(f"Starting SPADE router on {self.host}:{self.port}")
+        for index, backend in enumerate(self.backends):
+            print(f"    Shard {index}: {backend[0]}:{backend[1]}")
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as router:
+            router.bind((self.host, self.port))  # Bind the router to host and port
+            router.listen(server_client.BACKLOG)  # Listen for incoming connections
+            print(f"Listening on {self.host}:{self.port}")
+            while True:
+                conn, _ = router.accept()  # Accept connection
+
+                # Requests are handled in threads so slow shards do not block each other
+                threading.Thread(
+                    target=self.handle_request, args=(conn,), daemon=True
+                ).start()
+
+
+# Function for running a single shard, used when starting local shard processes
+def run_shard(host, port, shard_index, shard_count, token, ready):
+    server = server_client.SPADEServer(
+        q=server_client.Q,
+        g=server_client.G,
+        host=host,
+        port=port,
+        shard_index=shard_index,
+        shard_count=shard_count,
+        shard_token=token,
+    )
+    server.run(ready)
+
+
+# Function for starting shards as local processes on the ports following the router port
+def start_local_shards(host, port, shard_count, token):
+    backends = []
+    events = []
+    for index in range(shard_count):
+        backend = (host, port + index + 1)
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=run_shard,
+            args=(*backend, index, shard_count, token, ready),
+            daemon=True,
+        )
+        process.start()
+        backends.append(backend)
+        events.append(ready)
+
+    # Wait for every shard to accept connections before routing requests to them
+    for index, ready in enumerate(events):
+        if not ready.wait(SHARD_STARTUP_TIMEOUT):
+            raise RuntimeError(f"Shard {index} did not start listening.")
+    return backends
+
+
+if __name__ == "__main__":
+    if len(argv) == 4 and argv[3].isdigit():
+        # Start the given amount of shards as local processes sharing a random token
+        token = secrets.token_hex(16)
+        backends = start_local_shards(argv[1], int(argv[2]), int(argv[3]), token)
+    elif len(argv) > 4:
+        # Use shards started with 'python server_client.py <host> <port> <index> <count> <token>'
+        token = argv[3]
+        backends = []
+        for backend in argv[4:]:
+            backend_host, backend_port = backend.rsplit(":", 1)
+            backends.append((backend_host, int(backend_port)))
+    else:
+        # Print usage instructions if incorrect arguments are provided
+        print("Invalid number of arguments. Usage:")
+        print("     python router_client.py <host> <port> <shard count>")
+        print(
+            "     python router_client.py <host> <port> <token> <shard host:port> ..."
+        )
+        print("Example:")
+        print("     python router_client.py localhost 5000 4")
+        raise SystemExit(1)
+
+    router = SPADERouter(
+        host=argv[1], port=int(argv[2]), backends=backends, token=token
+    )
+    router.run()  # Start the router
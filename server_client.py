@@ -1,15 +1,30 @@
 from sys import argv
 import socket
 import struct
+import hashlib
+import hmac
+import tempfile
+import os
+import re
 import random
+import secrets
+import itertools
 import pickle
 import time
+import types
 
 ###-----CONFIG-----###
 
 # DEFAULT HOST AND PORT
 HOST = "localhost"  # Default hostname
 PORT = 5000  # Default port num
+BACKLOG = 128  # Amount of pending connections queued while a request is handled
+
+# BLOB STORE
+BLOB_DIR = "blobs"  # Directory for uploaded data, files are named by their sha256
+CHUNK_SIZE = 65536  # Maximum amount of bytes of encrypted data in a single frame
+WINDOW = 16  # Amount of uploaded chunks the server acknowledges at once
+FRAME_OVERHEAD = 1024  # Allowed serialization overhead of a single chunk frame
 
 # VALUES
 Q = 65537  # Prime modulus
@@ -18,58 +33,72 @@ G = 3  # Generator of group of order q
 
 # Class for hosting SPADE instances for different sizes of n.
 class SPADEInstance:
-    def __init__(self, n, q, g):
+    def __init__(self, n, q, g, msk=None):
         self.n = n
         self.q = q
         self.g = g
 
-        # Generating Master secret key MSK and deriving Master public key MPK
-        self.msk = [random.randint(1, q - 1) for _ in range(n)]
+        # Generating Master secret key MSK, unless one is replicated from another shard,
+        # and deriving Master public key MPK
+        if msk is None:
+            msk = [random.randint(1, q - 1) for _ in range(n)]
+        self.msk = msk
         self.mpk = [pow(g, s, q) for s in self.msk]
 
 
 # Class for the main SPADE server instance.
 class SPADEServer:
-    def __init__(self, q, g, host, port):
+    def __init__(
+        self,
+        q,
+        g,
+        host,
+        port,
+        blob_dir=BLOB_DIR,
+        shard_index=0,
+        shard_count=1,
+        shard_token=None,
+    ):
         self.q = q  # Prime modulus
         self.g = g  # Generator
         self.host = host  # Host address
         self.port = port  # Port number
+        self.blob_dir = blob_dir  # Directory for the content addressed blob store
+        self.shard_index = shard_index  # Index of this server in a sharded deployment
+        self.shard_count = shard_count  # Total amount of servers when sharded
+        self.shard_token = shard_token  # Secret shared with the router when sharded
         self.users = {}  # Dict for user information
         self.encrypted_data = {}  # Dict for user encrypted data information
         self.instances = {}  # Dict for SPADE instances
 
+        # Dataset versions are a counter prefixed by a random epoch of this process, so
+        # versions handed out after a restart never match ones cached by clients before it
+        self.epoch = secrets.token_hex(8)
+        self.versions = itertools.count(1)
+
     # Function for handling incoming client requests
     def handle_request(self, conn):
         try:
             start = time.time()  # Starting timer for transaction
 
-            # Receive a header for the length of the incoming data
-            raw_length = conn.recv(4)
-            if not raw_length:
-                raise EOFError("No data length header received.")
-            data_length = struct.unpack("!I", raw_length)[0]
-
-            # Receiving the actual data in chunks and stopping after received data length is reached.
-            data = b""
-            while len(data) < data_length:
-                packet = conn.recv(16384)
-                if not packet:
-                    raise EOFError("Connection closed before all data received.")
-                data += packet
+            data = self.recv_frame(conn)  # Receive the request data
 
             received_size = len(data)  # Total size of received data
             print(f"\n---Received {received_size} bytes from client.")
             if data:
                 # Deserializing the data and processing the request.
                 request = pickle.loads(data)
-                response = self.process_request(request)
+                response = self.process_request(request, conn)
 
-                # Serializing generated response and sending it back to the client.
-                response_data = pickle.dumps(response)
-                sent_size = len(response_data)
-                conn.sendall(struct.pack("!I", sent_size))  # Send data length header
-                conn.sendall(response_data)  # Send actual response data
+                if isinstance(response, types.GeneratorType):
+                    # Streamed responses are sent as one frame per item followed by a closing frame
+                    sent_size = 0
+                    for frame in response:
+                        sent_size += self.send_frame(conn, frame)
+                    sent_size += self.send_frame(conn, {"done": True})
+                else:
+                    # Serializing generated response and sending it back to the client.
+                    sent_size = self.send_frame(conn, response)
 
                 # Calculating total transaction time and printing information about the transaction.
                 transaction_time = time.time() - start
@@ -81,8 +110,41 @@ class SPADEServer:
         finally:
             conn.close()  # Close the connection
 
+    # Function for sending a single length prefixed response frame to the client
+    def send_frame(self, conn, response):
+        response_data = pickle.dumps(response)
+        sent_size = len(response_data)
+        conn.sendall(struct.pack("!I", sent_size))  # Send data length header
+        conn.sendall(response_data)  # Send actual response data
+        return sent_size
+
+    # Function for receiving a single length prefixed frame from the client
+    def recv_frame(self, conn, max_length=None):
+        # Receive a header for the length of the incoming data
+        raw_length = b""
+        while len(raw_length) < 4:
+            packet = conn.recv(4 - len(raw_length))
+            if not packet:
+                raise EOFError("No data length header received.")
+            raw_length += packet
+        data_length = struct.unpack("!I", raw_length)[0]
+        if max_length is not None and data_length > max_length:
+            raise ValueError(
+                f"Frame of {data_length} bytes exceeds limit of {max_length}."
+            )
+
+        # Receiving the actual data in chunks and stopping after received data length is reached.
+        # Reads never go past the end of the frame so following frames stay intact.
+        data = b""
+        while len(data) < data_length:
+            packet = conn.recv(min(16384, data_length - len(data)))
+            if not packet:
+                raise EOFError("Connection closed before all data received.")
+            data += packet
+        return data
+
     # Function for processing client requests
-    def process_request(self, request):
+    def process_request(self, request, conn=None):
         action = request.get("action")  # Get action from client request.
 
         if action == "register_user":
@@ -95,20 +157,39 @@ class SPADEServer:
             user_id = request.get("user_id")
             return self.derive_key(user_id, v)
 
+        elif action == "derive_key_batch":
+            # Derive functional keys for several users and values, streamed per SPADE instance
+            values = request.get("values")
+            user_ids = request.get("user_ids")
+            return self.derive_key_batch(user_ids, values)
+
         elif action == "get_public_parameters":
             # Provide public parameters to the client
             print("A client is requesting public parameters.")
             n = request.get("n")
-            if n not in self.instances:
-                # Create a new SPADE instance if one does not exist for data length n
-                print("     No SPADE instance for requested data length.")
-                print(f"     Creating new SPADE instance for n of {n}.")
-                inst = SPADEInstance(n, self.q, self.g)
-                self.instances[n] = inst
+            if n not in self.instances and self.shard_index != 0:
+                # Only the first shard creates instances, others receive them from the router
+                print("Error: No SPADE instance for requested data length.")
+                return {"error": "No SPADE instance for requested data length."}
 
+            inst = self.get_instance(n)
             print("    Sending public parameters.")
             # Return public parameters for SPADE instance.
-            return {"q": self.q, "g": self.g, "mpk": self.instances[n].mpk}
+            return {"q": self.q, "g": self.g, "mpk": inst.mpk}
+
+        elif action == "export_instance" and self.is_router(request):
+            # Provide a SPADE instance to the router for replication to the other shards
+            print("The router is requesting a SPADE instance.")
+            n = request.get("n")
+            inst = self.get_instance(n)
+            return {"q": self.q, "g": self.g, "mpk": inst.mpk, "msk": inst.msk}
+
+        elif action == "import_instance" and self.is_router(request):
+            # Store a SPADE instance replicated by the router from the first shard
+            n = request.get("n")
+            print(f"The router is replicating the SPADE instance for n of {n}.")
+            self.instances[n] = SPADEInstance(n, self.q, self.g, request.get("msk"))
+            return {"n": n}
 
         elif action == "store_data":
             # Store encrypted data submitted by the client
@@ -116,20 +197,75 @@ class SPADEServer:
             user_id = request.get("id")
             encrypted_data = request.get("encrypted_data")
             data_len = request.get("n")
-            user_data = [encrypted_data, data_len]
-            self.encrypted_data[user_id] = (
-                user_data  # Store the data with user_id as key
-            )
+            # Blob references are only created by uploads into the blob store
+            if not isinstance(encrypted_data, str) or encrypted_data[:5] == "blob:":
+                print("Error: Invalid encrypted data location.")
+                return {"error": "Invalid encrypted data location."}
+            version = self.store_user_data(user_id, encrypted_data, data_len)
 
             print(f"User ID: {user_id}")
+            # Report the new dataset version so cached copies of older data can be dropped
+            return {"version": version}
+
+        elif action == "get_dataset_version":
+            # Provide the version of a user's stored data
+            user_id = request.get("user_id")
+            if user_id not in self.encrypted_data:
+                return {"error": "No data stored."}
+            return {"version": self.encrypted_data[user_id][2]}
+
+        elif action == "upload_data":
+            # Receive encrypted data streamed by the client into the blob store
+            print("A client is uploading data.")
+            user_id = request.get("id")
+            data_len = request.get("n")
+            return self.receive_upload(conn, user_id, data_len)
+
+        elif action == "download_data":
+            # Stream a range of a user's encrypted data back to the client
+            print("A client is downloading data.")
+            user_id = request.get("user_id")
+            offset = request.get("offset", 0)
+            length = request.get("length")
+            return self.send_download(user_id, offset, length)
 
         return {"error": "Unknown action"}  # Handle unreqcognized actions
 
+    # Function for checking that a request carries the token shared with the router. Requests
+    # exchanging master secret keys are only accepted from the router.
+    def is_router(self, request):
+        token = request.get("token")
+        if self.shard_token is None or not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token, self.shard_token)
+
+    # Function for storing information about a user's encrypted data and returning its version
+    def store_user_data(self, user_id, encrypted_data, data_len):
+        # Every store of data gets a new version unique to this server process
+        version = f"{self.epoch}-{next(self.versions)}"
+
+        # Store the data with user_id as key
+        self.encrypted_data[user_id] = [encrypted_data, data_len, version]
+        return version
+
+    # Function for retrieving the SPADE instance for data length n
+    def get_instance(self, n):
+        if n not in self.instances:
+            # Create a new SPADE instance if one does not exist for data length n
+            print("     No SPADE instance for requested data length.")
+            print(f"     Creating new SPADE instance for n of {n}.")
+            inst = SPADEInstance(n, self.q, self.g)
+            self.instances[n] = inst
+
+        return self.instances[n]
+
     # Function for registering a new user and generating their keys
     def register_user(self):
         alpha_j = random.randint(1, self.q - 1)  # Generate user private key
         g_alpha_j = pow(self.g, alpha_j, self.q)  # Compute user public key
-        user_id = len(self.users) + 1  # Assing a unique ID for the user
+        # Assing a unique ID for the user. Shards hand out every shard_count'th ID starting
+        # from their own index, so IDs are unique across shards and map back to this shard.
+        user_id = len(self.users) * self.shard_count + self.shard_index + 1
         self.users[user_id] = {
             "alpha_j": alpha_j,
             "g_alpha_j": g_alpha_j,
@@ -156,15 +292,163 @@ class SPADEServer:
             for i in range(data_len)
         ]
         # Return derived key and data length to client
-        return {"dk": dk, "encrypted_data": self.encrypted_data[user_id], "n": data_len}
+        return {
+            "dk": dk,
+            "encrypted_data": self.encrypted_data[user_id],
+            "n": data_len,
+            "version": self.encrypted_data[user_id][2],
+        }
+
+    # Function for receiving streamed encrypted data and writing it into the blob store
+    def receive_upload(self, conn, user_id, data_len):
+        if user_id not in self.users:  # Ensure that the user exists
+            print("Error: User not found.")
+            return {"error": "User not found."}
+
+        # Tell the client how large chunks may be and how often they are acknowledged
+        self.send_frame(conn, {"chunk_size": CHUNK_SIZE, "window": WINDOW})
+
+        # Write chunks to a temporary file while hashing them, so memory use does not depend
+        # on the size of the data. The client waits for an acknowledgement every WINDOW chunks.
+        os.makedirs(self.blob_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        chunks = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as blob:
+                while True:
+                    frame = pickle.loads(
+                        self.recv_frame(conn, CHUNK_SIZE + FRAME_OVERHEAD)
+                    )
+                    if frame.get("done"):
+                        break
+                    chunk = frame["chunk"]
+                    blob.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    chunks += 1
+                    if chunks % WINDOW == 0:
+                        self.send_frame(conn, {"received": size})
+
+            # Name the blob by its content, identical uploads share a single file
+            blob_id = digest.hexdigest()
+            os.replace(tmp_path, os.path.join(self.blob_dir, blob_id))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        version = self.store_user_data(user_id, "blob:" + blob_id, data_len)
+        print(f"User ID: {user_id}")
+        print(f"    Stored {size} bytes as blob {blob_id}")
+        return {"blob": blob_id, "size": size, "version": version}
+
+    # Function for finding the blob store file of a user's uploaded data, returns None if the
+    # user has no uploaded data or the stored blob id is not a sha256 inside the blob store
+    def blob_path(self, user_id):
+        user_data = self.encrypted_data.get(user_id)
+        if user_data is None or not user_data[0].startswith("blob:"):
+            return None
+
+        blob_id = user_data[0][len("blob:") :]
+        if not re.fullmatch("[0-9a-f]{64}", blob_id):
+            return None
+
+        blob_dir = os.path.realpath(self.blob_dir)
+        path = os.path.realpath(os.path.join(blob_dir, blob_id))
+        if os.path.dirname(path) != blob_dir or not os.path.isfile(path):
+            return None
+        return path
+
+    # Function for streaming a range of a user's encrypted data from the blob store
+    def send_download(self, user_id, offset, length):
+        path = self.blob_path(user_id)
+        if path is None:
+            print("Error: No uploaded data for user.")
+            yield {"error": "No uploaded data for user."}
+            return
+
+        size = os.path.getsize(path)
+        offset = min(max(offset, 0), size)
+        end = size if length is None else min(size, offset + length)
+
+        # Send the range information first, then the data one chunk at a time
+        yield {"size": size, "offset": offset, "length": end - offset}
+        with open(path, "rb") as blob:
+            blob.seek(offset)
+            while offset < end:
+                chunk = blob.read(min(CHUNK_SIZE, end - offset))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield {"chunk": chunk}
+
+    # Function for deriving functional keys for a list of users and values
+    def derive_key_batch(self, user_ids, values):
+        print("A client is requesting a batch of keys and data.")
+        print(f"    {len(user_ids)} users, values {values}")
+
+        # Group users by the SPADE instance their data was encrypted with
+        groups = {}
+        errors = []
+        for user_id in user_ids:
+            if user_id not in self.users:
+                errors.append({"user_id": user_id, "error": "User not found."})
+            elif user_id not in self.encrypted_data:
+                errors.append({"user_id": user_id, "error": "No data stored."})
+            else:
+                data_len = self.encrypted_data[user_id][1]
+                groups.setdefault(data_len, []).append(user_id)
+
+        # Report users that could not be processed before streaming the keys
+        if errors:
+            yield {"errors": errors}
+
+        for data_len, group in groups.items():
+            inst = self.instances[data_len]  # SPADE instance shared by the group
+
+            # Send the public parameters once per instance, so the client does not need
+            # another request while the stream is open
+            yield {"n": data_len, "q": self.q, "g": self.g, "mpk": inst.mpk}
+
+            for user_id in group:
+                alpha_j = self.users[user_id]["alpha_j"]
+
+                # g^(alpha_j * (v - msk_i)) is split into g^(-alpha_j * msk_i), computed once per
+                # user, and g^(alpha_j * v), computed once per value.
+                base = [pow(self.g, -alpha_j * s, self.q) for s in inst.msk]
+                dks = {}
+                for v in values:
+                    scale = pow(self.g, alpha_j * v, self.q)
+                    dks[v] = [scale * b % self.q for b in base]
+
+                # Send one frame per user so frame size does not grow with the cohort
+                frame = {
+                    "n": data_len,
+                    "user_id": user_id,
+                    "dks": dks,
+                    "encrypted_data": self.encrypted_data[user_id],
+                    "version": self.encrypted_data[user_id][2],
+                }
+
+                # Uploaded data is sent along, so the client can decrypt the user without
+                # another request while the stream is still open
+                path = self.blob_path(user_id)
+                if path is not None:
+                    with open(path, "rb") as blob:
+                        frame["blob"] = blob.read()
+
+                yield frame
 
     # Function for starting the server instance
-    def run(self):
+    def run(self, ready=None):
         print(f"Starting SPADE server on {self.host}:{self.port}")
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
             server.bind((self.host, self.port))  # Bind the server to host and port
-            server.listen(5)  # Listen for incoming connections
+            server.listen(BACKLOG)  # Listen for incoming connections
             print(f"Listening on {self.host}:{self.port}")
+            if ready is not None:
+                ready.set()  # Tell the process starting the server that it accepts connections
             while True:
                 conn, _ = server.accept()  # Accept connection
                 self.handle_request(conn)  # Handle client request
@@ -174,6 +458,17 @@ if __name__ == "__main__":
     if len(argv) == 3:
         # Use CLI args for host and port if provided
         server = SPADEServer(q=Q, g=G, host=argv[1], port=int(argv[2]))
+    elif len(argv) == 6:
+        # Run as one shard of a sharded deployment behind router_client.py
+        server = SPADEServer(
+            q=Q,
+            g=G,
+            host=argv[1],
+            port=int(argv[2]),
+            shard_index=int(argv[3]),
+            shard_count=int(argv[4]),
+            shard_token=argv[5],
+        )
     else:
         # Else use default host and port values
         server = SPADEServer(q=Q, g=G, host=HOST, port=PORT)
@@ -1,5 +1,6 @@
 from sys import argv
 import socket
+import os
 import pickle
 import random
 import struct
@@ -39,26 +40,75 @@ class SPADEUser:
     def send_request(self, request):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
             client.connect((self.host, self.port))  # Connect to server
-            serialized_data = pickle.dumps(request)  # Serialize request data
-            client.sendall(struct.pack("!I", len(serialized_data)))  # Send data length
-            client.sendall(serialized_data)  # Send the actual request data
+            self.send_frame(client, request)  # Send the request
+            response = self.recv_frame(client)  # Receive response
+            return response
 
-            # Receive data length header
-            raw_length = client.recv(4)
-            if not raw_length:
+    # Function for sending a single length prefixed frame to the server
+    def send_frame(self, client, request):
+        serialized_data = pickle.dumps(request)  # Serialize request data
+        client.sendall(struct.pack("!I", len(serialized_data)))  # Send data length
+        client.sendall(serialized_data)  # Send the actual request data
+
+    # Function for receiving a single length prefixed response frame
+    def recv_frame(self, client):
+        # Receive data length header
+        raw_length = b""
+        while len(raw_length) < 4:
+            packet = client.recv(4 - len(raw_length))
+            if not packet:
                 raise EOFError("No data length header received.")
-            data_length = struct.unpack("!I", raw_length)[0]
-
-            # Receive actual response in chunks
-            data = b""
-            while len(data) < data_length:
-                packet = client.recv(16384)
-                if not packet:
-                    raise EOFError("Connection closed before all data received.")
-                data += packet
+            raw_length += packet
+        data_length = struct.unpack("!I", raw_length)[0]
+
+        # Receive actual response in chunks, never reading past the end of the frame
+        data = b""
+        while len(data) < data_length:
+            packet = client.recv(min(16384, data_length - len(data)))
+            if not packet:
+                raise EOFError("Connection closed before all data received.")
+            data += packet
+
+        response = pickle.loads(data)  # Deserialize response
+        return response
+
+    # Function for streaming an encrypted data file into the server's blob store
+    def upload_data(self, filename, n):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+            client.connect((self.host, self.port))  # Connect to server
+            self.send_frame(
+                client, {"action": "upload_data", "id": self.user_id, "n": n}
+            )
 
-            response = pickle.loads(data)  # Deserialize response
-            return response
+            # Server replies with the chunk size and acknowledgement window to use
+            response = self.recv_frame(client)
+            if response.get("error") is not None:
+                print(f"Error: {response['error']}")
+                return response
+
+            chunk_size = response["chunk_size"]
+            window = response["window"]
+
+            # Send the file in chunks and wait for an acknowledgement every window of chunks,
+            # so the client never runs ahead of what the server has written.
+            chunks = 0
+            with open(filename, "rb") as enc_f:
+                while True:
+                    chunk = enc_f.read(chunk_size)
+                    if not chunk:
+                        break
+                    self.send_frame(client, {"chunk": chunk})
+                    chunks += 1
+                    if chunks % window == 0:
+                        self.recv_frame(client)
+
+            self.send_frame(client, {"done": True})
+            response = self.recv_frame(client)  # Receive blob information
+
+        # Print information about the upload if being ran in client and not perftests
+        if __name__ == "__main__":
+            print(f"Uploaded {os.path.getsize(filename)} bytes.")
+        return response
 
     # Function for registering the user on the SPADE server
     def register(self):
@@ -86,12 +136,7 @@ class SPADEUser:
     def encrypt_genome(self, filename):
         data = []
         try:
-            with open(filename, "r") as file:
-                # Read the dna data from file and convert dinucleotides to integers.
-                content = file.read().replace("\n", "")
-                for i in range(0, len(content), 2):
-                    num_value = DINUCLEOTIDE_VALUE_TABLE[content[i : i + 2]]
-                    data.append(num_value)
+            data = read_genome(filename)
 
         except FileNotFoundError:
             print(f"Could not find file '{filename}'.")
@@ -106,33 +151,16 @@ class SPADEUser:
         h, c = cipher.encrypt(data, self.private_key)  # Encrypt the data
 
         # Write the encrypted data to a new file
-        with open(filename + ".encrypted", "w") as enc_f:
-            for datapoint in h:
-                enc_f.write(str(datapoint) + "\n")
-
-            enc_f.write(":\n")
+        write_encrypted(filename + ".encrypted", h, c)
 
-            for datapoint in c:
-                enc_f.write(str(datapoint) + "\n")
-
-        # Send information about the encrypted data to server
-        request = {
-            "action": "store_data",
-            "id": self.user_id,
-            "encrypted_data": "file:" + filename + ".encrypted",
-            "n": n,
-        }
-
-        self.send_request(request)  # Send request
+        # Upload the encrypted data to the server
+        self.upload_data(filename + ".encrypted", n)
 
     # Function for encrypting hypnogram data from a file and sending resulting information to server
     def encrypt_hypnogram(self, filename):
         data = []
         try:
-            with open(filename, "r") as file:
-                # Read and save data from hypnogram file
-                for line in file:
-                    data.append(int(line))
+            data = read_hypnogram(filename)
 
         except FileNotFoundError:
             print(f"Could not find file '{filename}'.")
@@ -148,24 +176,42 @@ class SPADEUser:
         h, c = cipher.encrypt(data, self.private_key)  # Encrypt the data
 
         # Write the encrypted data to a new file
-        with open(filename + ".encrypted", "w") as enc_f:
-            for datapoint in h:
-                enc_f.write(str(datapoint) + "\n")
+        write_encrypted(filename + ".encrypted", h, c)
+
+        # Upload the encrypted data to the server
+        self.upload_data(filename + ".encrypted", n)
+
+
+# Function for reading dna data from a file and converting dinucleotides to integers
+def read_genome(filename):
+    data = []
+    with open(filename, "r") as file:
+        content = file.read().replace("\n", "")
+        for i in range(0, len(content), 2):
+            num_value = DINUCLEOTIDE_VALUE_TABLE[content[i : i + 2]]
+            data.append(num_value)
+    return data
+
+
+# Function for reading hypnogram data from a file
+def read_hypnogram(filename):
+    data = []
+    with open(filename, "r") as file:
+        for line in file:
+            data.append(int(line))
+    return data
 
-            enc_f.write(":\n")
 
-            for datapoint in c:
-                enc_f.write(str(datapoint) + "\n")
+# Function for writing helping information and ciphertext to an encrypted data file
+def write_encrypted(filename, h, c):
+    with open(filename, "w") as enc_f:
+        for datapoint in h:
+            enc_f.write(str(datapoint) + "\n")
 
-        # Send information about the encrypted data to server
-        request = {
-            "action": "store_data",
-            "id": self.user_id,
-            "encrypted_data": "file:" + filename + ".encrypted",
-            "n": n,
-        }
+        enc_f.write(":\n")
 
-        self.send_request(request)  # Send request
+        for datapoint in c:
+            enc_f.write(str(datapoint) + "\n")
 
 
 # CLI interface for hypnogram encryption